@@ -0,0 +1,156 @@
+'''
+Representative weight and quorum analysis on an array-backed snapshot
+of the ledger.
+
+Requires numpy.
+'''
+import numpy as np
+
+# Account with the lowest public key, where a full ledger walk starts
+FIRST_ACCOUNT = 'xrb_1111111111111111111111111111111111111111111111111111hifc8npp'
+
+_LIMB = 0xffffffff
+_HALF = 0xffffffffffffffff
+
+class WeightSnapshot:
+    '''
+    Balances and representatives of all accounts, stored as columns:
+
+    Attribute          Value
+    'accounts'         bytes array of xrb_ addresses
+    'representatives'  list of distinct representative xrb_ addresses
+    'rep_index'        int32 array, index into representatives per account
+    'balance_hi'       uint64 array, upper 64 bits of the balance in raw
+    'balance_lo'       uint64 array, lower 64 bits of the balance in raw
+    '''
+    def __init__(self, accounts, representatives, rep_index,
+            balance_hi, balance_lo):
+        self.accounts = accounts
+        self.representatives = representatives
+        self.rep_index = rep_index
+        self.balance_hi = balance_hi
+        self.balance_lo = balance_lo
+        self._weights = None
+
+    def __len__(self):
+        return len(self.accounts)
+
+    @classmethod
+    def from_ledger(cls, node, page_size=10000, start=FIRST_ACCOUNT):
+        '''
+        Builds a snapshot from paged ledger calls on node (a Rai_node),
+        walking all accounts from start on. Every page after the first
+        one repeats the previous last account, so page_size must be at
+        least 2.
+        '''
+        if page_size < 2:
+            raise ValueError('page_size must be at least 2')
+        rep_ids = {}
+        columns = ([], [], [], [])
+        account = start
+        first = True
+        while True:
+            page = node.ledger(account, page_size) or {}
+            names = list(page)
+            if not first and names and names[0] == account:
+                # Pages after the first one start with the previous last one
+                names = names[1:]
+            first = False
+            if names:
+                balances = [int(page[name]['balance']) for name in names]
+                reps = [rep_ids.setdefault(page[name].get('representative', ''),
+                        len(rep_ids)) for name in names]
+                columns[0].append(np.array(names, dtype='S'))
+                columns[1].append(np.array(reps, dtype=np.int32))
+                columns[2].append(np.array([b >> 64 for b in balances],
+                        dtype=np.uint64))
+                columns[3].append(np.array([b & _HALF for b in balances],
+                        dtype=np.uint64))
+                account = names[-1]
+            if len(page) < page_size or not names:
+                break
+
+        if not columns[0]:
+            return cls(np.array([], dtype='S'), [],
+                    np.array([], dtype=np.int32),
+                    np.array([], dtype=np.uint64),
+                    np.array([], dtype=np.uint64))
+        return cls(np.concatenate(columns[0]), list(rep_ids),
+                np.concatenate(columns[1]), np.concatenate(columns[2]),
+                np.concatenate(columns[3]))
+
+    def delegator_counts(self):
+        '''
+        Returns an int64 array with the number of delegators per
+        representative, aligned with representatives.
+        '''
+        return np.bincount(self.rep_index, minlength=len(self.representatives))
+
+    def weights(self):
+        '''
+        Returns the voting weight in raw (python int) per representative,
+        aligned with representatives.
+        '''
+        if self._weights is not None:
+            return self._weights
+        n = len(self.representatives)
+        if not n:
+            self._weights = []
+            return self._weights
+        order = np.argsort(self.rep_index, kind='stable')
+        grouped = self.rep_index[order]
+        starts = np.flatnonzero(np.r_[True, grouped[1:] != grouped[:-1]])
+        present = grouped[starts]
+        # Sum 32 bit limbs so uint64 sums can not overflow
+        hi = self.balance_hi[order]
+        lo = self.balance_lo[order]
+        sums = []
+        for limb in (lo & _LIMB, lo >> 32, hi & _LIMB, hi >> 32):
+            total = np.zeros(n, dtype=np.uint64)
+            total[present] = np.add.reduceat(limb, starts)
+            sums.append(total.tolist())
+        self._weights = [a + (b << 32) + (c << 64) + (d << 96)
+                for a, b, c, d in zip(*sums)]
+        return self._weights
+
+    def total_weight(self):
+        ''' Returns the sum of all balances in raw '''
+        return sum(self.weights())
+
+    def top(self, n=10):
+        '''
+        Returns the n heaviest representatives as a list of tuples
+        (representative, weight in raw, share of total weight, delegators)
+        '''
+        weights = self.weights()
+        counts = self.delegator_counts()
+        total = sum(weights) or 1
+        order = sorted(range(len(weights)), key=weights.__getitem__,
+                reverse=True)
+        return [(self.representatives[i], weights[i], weights[i] / total,
+                int(counts[i])) for i in order[:n]]
+
+    def concentration(self, n=10):
+        ''' Returns the share of total weight held by the n heaviest '''
+        total = self.total_weight()
+        if not total:
+            return 0.0
+        return sum(weight for _, weight, _, _ in self.top(n)) / total
+
+    def quorum(self, fraction=0.5):
+        '''
+        Returns the smallest list of representatives whose combined
+        weight exceeds fraction of the total weight, heaviest first.
+        '''
+        weights = self.weights()
+        threshold = self.total_weight() * fraction
+        order = sorted(range(len(weights)), key=weights.__getitem__,
+                reverse=True)
+        reps = []
+        running = 0
+        for i in order:
+            if running > threshold:
+                break
+            reps.append(self.representatives[i])
+            running += weights[i]
+        return reps
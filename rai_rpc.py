@@ -1,13 +1,697 @@
 import requests
+import copy
+import functools
+import heapq
+import inspect
+import itertools
 import json
-from pprint import pprint
+import math
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import (ThreadPoolExecutor, FIRST_COMPLETED,
+        as_completed, wait)
 
 # TODO: Error handling
 
+_ACTION_RE = re.compile(r'"action"\s*:\s*"([^"]*)"')
+
+def _action_of(data):
+    ''' Extracts the action name out of a (possibly sloppy) JSON request '''
+    match = _ACTION_RE.search(data)
+    return match.group(1) if match else None
+
+_ADDRESS_RE = re.compile(r'(?:xrb|nano)_[13][13-9a-km-uw-z]{59}')
+
+def _chunks(items, size):
+    ''' Lazily splits any iterable into lists of up to size items '''
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _bounded_map(fn, items, workers):
+    '''
+    Lazily runs fn over items on workers threads, yielding results as
+    they complete, with at most 2 * workers items pending.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for item in items:
+            pending.add(pool.submit(fn, item))
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(pending):
+            yield future.result()
+
+class RpcError(Exception):
+    ''' The node answered with an error, or with a bad HTTP status '''
+
+class BulkCreateError(RpcError):
+    '''
+    Some accounts_create calls of bulk_accounts_create() failed.
+
+    created holds the addresses that were created anyway, errors the
+    exception of every failed call.
+    '''
+    def __init__(self, created, errors):
+        RpcError.__init__(self, '%d accounts_create calls failed, %d '
+                'accounts created: %s' % (len(errors), len(created), errors[0]))
+        self.created = created
+        self.errors = errors
+
+class _NotFound:
+    def __repr__(self):
+        return 'NOT_FOUND'
+
+# Marks accounts walk_chains() found no frontier for
+NOT_FOUND = _NotFound()
+
+# Default priority lanes, lower lanes are served first
+PAYMENT_LANE = 0
+DEFAULT_LANE = 1
+BULK_LANE = 2
+
+DEFAULT_LANES = {
+    'send': PAYMENT_LANE,
+    'receive': PAYMENT_LANE,
+    'process': PAYMENT_LANE,
+    'block_create': PAYMENT_LANE,
+    'payment_begin': PAYMENT_LANE,
+    'payment_end': PAYMENT_LANE,
+    'payment_init': PAYMENT_LANE,
+    'payment_wait': PAYMENT_LANE,
+    'work_generate': PAYMENT_LANE,
+    'account_history': BULK_LANE,
+    'blocks': BULK_LANE,
+    'blocks_info': BULK_LANE,
+    'chain': BULK_LANE,
+    'delegators': BULK_LANE,
+    'frontiers': BULK_LANE,
+    'history': BULK_LANE,
+    'ledger': BULK_LANE,
+}
+
+class TokenBucket:
+    '''
+    Allows rate calls per second on average with bursts of up to burst calls.
+    '''
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        ''' Blocks until a token is available and consumes it '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                        self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+class AdaptiveLimiter:
+    '''
+    Bounds the number of in-flight RPC calls and adapts that bound to
+    how fast the node answers.
+
+    The limit grows by one call per limit successful calls (additive
+    increase) and is multiplied by backoff (multiplicative decrease)
+    when a call fails or the latency gradient of its action gets too
+    steep: the short term average latency (an EWMA with weight short)
+    exceeding tolerance times the long term one (weight long). Averaging
+    keeps a mix of small and full size calls of one action from looking
+    like congestion. Only calls started after the last decrease can
+    trigger another one.
+
+    rates maps actions to (calls per second, burst) token buckets, e.g.
+        {'work_generate': (2, 4), 'ledger': (5, 5)}
+    lanes maps actions to priority lanes (see DEFAULT_LANES); when the
+    limit is reached, waiting calls of lower lanes are let through first.
+    work_generate is in the payment lane since payments need work before
+    they can be processed; throttle it with rates instead.
+    '''
+    def __init__(self, initial=8, minimum=1, maximum=256, backoff=0.5,
+            tolerance=2.0, short=0.5, long=0.05, rates=None, lanes=None):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.short = short
+        self.long = long
+        self.lanes = DEFAULT_LANES if lanes is None else lanes
+        self._buckets = {action: TokenBucket(*rate)
+                for action, rate in (rates or {}).items()}
+        # action: (short term, long term average latency, samples)
+        self._latencies = {}
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self, action=None):
+        ''' Blocks until a call of action may be sent '''
+        bucket = self._buckets.get(action)
+        if bucket is not None:
+            bucket.take()
+        entry = (self.lanes.get(action, DEFAULT_LANE), next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while (self._waiting[0] != entry or
+                    self._in_flight >= max(1, int(self.limit))):
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._in_flight += 1
+            self._cond.notify_all()
+
+    def release(self, action, latency, ok=True):
+        '''
+        Marks a call of action as finished after latency seconds and
+        adjusts the limit.
+        '''
+        now = time.monotonic()
+        with self._cond:
+            self._in_flight -= 1
+            short, long, count = self._latencies.get(action,
+                    (latency, latency, 0))
+            short += self.short * (latency - short)
+            long += self.long * (latency - long)
+            count += 1
+            self._latencies[action] = (short, long, count)
+            # The long term average needs about 1 / long samples to settle
+            steep = count * self.long >= 1 and short > self.tolerance * long
+            if not ok or steep:
+                if now - latency > self._last_decrease:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+# Response size recorded for calls that raised
+FAILED_SIZE = -1
+
+class TrafficCapture:
+    '''
+    Append-only record of the RPC traffic sent by a Rai_node.
+
+    Every call is written as one JSON line when it completes
+        [start time, duration in seconds, response size in bytes, request]
+    so lines are not ordered by start time. Calls that raised instead of
+    getting a response are recorded with a size of FAILED_SIZE.
+    See replay() to re-issue a capture.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, start, duration, size, data):
+        try:
+            data = json.dumps(json.loads(data), separators=(',', ':'))
+        except ValueError:
+            pass
+        line = json.dumps([round(start, 6), round(duration, 6), size, data],
+                separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class _LatencyHistogram:
+    '''
+    Constant memory latency distribution with log spaced buckets 1% wide,
+    from 1 microsecond up.
+    '''
+    _FLOOR = 1e-6
+    _STEP = math.log(1.01)
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.max = None
+
+    def add(self, latency):
+        index = max(0, int(math.log(max(latency, self._FLOOR) / self._FLOOR)
+                / self._STEP))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        if self.max is None or latency > self.max:
+            self.max = latency
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = min(self.count - 1, int(fraction * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(self.max, self._FLOOR * 1.01 ** (index + 1))
+
+def _calls_by_start(capture, window):
+    '''
+    Yields (start time, request) of capture lines roughly in start order.
+
+    Lines are written when calls complete, so they are held back in a
+    heap until a call completing more than window seconds after their
+    start was read. Only calls that ran longer than window can come out
+    of order, and memory is bounded by the calls of window seconds.
+    '''
+    pending = []
+    seq = itertools.count()
+    horizon = None
+    for line in capture:
+        if not line.strip():
+            continue
+        stamp, duration, _, data = json.loads(line)
+        heapq.heappush(pending, (stamp, next(seq), data))
+        done = stamp + duration - window
+        if horizon is None or done > horizon:
+            horizon = done
+        while pending and pending[0][0] <= horizon:
+            stamp, _, data = heapq.heappop(pending)
+            yield stamp, data
+    while pending:
+        stamp, _, data = heapq.heappop(pending)
+        yield stamp, data
+
+def replay(path, uri, speed=1.0, concurrency=8, window=60.0):
+    '''
+    Re-issues the requests of a TrafficCapture file against uri.
+
+    With speed=1.0 requests go out at their original pace, speed=2.0 is
+    twice as fast and speed=None sends them as fast as concurrency
+    allows. Requests are sent in order of their start time; since the
+    capture is written in completion order, lines are reordered within
+    window seconds (see _calls_by_start()). The capture is streamed and
+    latencies go into a histogram, so memory does not grow with the size
+    of the capture.
+
+    Returns a dict with the keys:
+    Key            Value
+    'requests'     number of requests sent
+    'errors'       number of failed requests
+    'duration'     seconds the replay took
+    'throughput'   requests per second
+    'latency'      dict of 'p50', 'p90', 'p99' and 'max' latencies in
+                   seconds, percentiles accurate to 1%
+    '''
+    latencies = _LatencyHistogram()
+    errors = [0]
+    lock = threading.Lock()
+    slots = threading.Semaphore(concurrency)
+
+    def send(data):
+        start = time.monotonic()
+        try:
+            ok = requests.post(uri, data=data).ok
+        except requests.RequestException:
+            ok = False
+        finally:
+            slots.release()
+        with lock:
+            latencies.add(time.monotonic() - start)
+            if not ok:
+                errors[0] += 1
+
+    begin = time.monotonic()
+    first = None
+    with open(path) as capture, \
+            ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for stamp, data in _calls_by_start(capture, window):
+            if first is None:
+                first = stamp
+            if speed:
+                delay = (stamp - first) / speed - (time.monotonic() - begin)
+                if delay > 0:
+                    time.sleep(delay)
+            slots.acquire()
+            pool.submit(send, data)
+    duration = time.monotonic() - begin
+    return {
+        'requests': latencies.count,
+        'errors': errors[0],
+        'duration': duration,
+        'throughput': latencies.count / duration if duration else 0.0,
+        'latency': {
+            'p50': latencies.percentile(0.5),
+            'p90': latencies.percentile(0.9),
+            'p99': latencies.percentile(0.99),
+            'max': latencies.max,
+            },
+        }
+
+def serve_stand_in(port=7076, host='::1', responses=None, delay=0.0):
+    '''
+    Runs a stand-in for rai_node that answers every action with
+    responses[action] (default {}) after delay seconds. Useful to measure
+    replay() and the client side without a real node. Blocks until
+    interrupted.
+    '''
+    import socket
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    responses = responses or {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            action = _action_of(data.decode(errors='replace'))
+            if delay:
+                time.sleep(delay)
+            body = json.dumps(responses.get(action, {})).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        address_family = socket.AF_INET6 if ':' in host else socket.AF_INET
+        daemon_threads = True
+
+    with Server((host, port), Handler) as server:
+        server.serve_forever()
+
+def replay_main(argv=None):
+    '''
+    Command line entry point of replay and the stand-in node, see --help
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(prog='rai_rpc.py replay',
+            description='Replays a TrafficCapture file against a node, or '
+            'runs a stand-in node with --serve.')
+    parser.add_argument('capture', nargs='?',
+            help='capture file written by TrafficCapture')
+    parser.add_argument('--uri', default='http://[::1]:7076',
+            help='target RPC address (default: %(default)s)')
+    parser.add_argument('--speed', type=float, default=1.0,
+            help='pace relative to the capture, 0 for as fast as possible '
+            '(default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+            help='parallel requests (default: %(default)s)')
+    parser.add_argument('--window', type=float, default=60.0,
+            help='seconds capture lines are reordered within '
+            '(default: %(default)s)')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+            help='run a stand-in node on PORT instead of replaying')
+    parser.add_argument('--responses',
+            help='JSON file mapping actions to stand-in responses')
+    parser.add_argument('--delay', type=float, default=0.0,
+            help='seconds the stand-in node waits per request')
+    args = parser.parse_args(argv)
+
+    if args.serve is not None:
+        responses = None
+        if args.responses:
+            with open(args.responses) as f:
+                responses = json.load(f)
+        serve_stand_in(args.serve, responses=responses, delay=args.delay)
+        return
+    if args.capture is None:
+        parser.error('a capture file is needed unless --serve is given')
+    stats = replay(args.capture, args.uri, args.speed or None,
+            args.concurrency, args.window)
+    print(json.dumps(stats, indent=2))
+
+# method: (seconds served without any check, seconds served while the
+# account frontier is unchanged). account_weight and pending depend on
+# the chains of other accounts (delegators, senders), so they are only
+# cached for a fixed time. The 'pending' field of account_balance and
+# account_information changes the same way, so it is only bounded by
+# the second, time based value; keep it short.
+DEFAULT_STALENESS = {
+    'account_balance': (2, 30),
+    'account_information': (2, 30),
+    'account_representative': (10, 3600),
+    'account_weight': (30, 30),
+    'pending': (2, 2),
+}
+
+# Returned by AccountCache._frontier() when the lookup failed
+_NO_FRONTIER = object()
+
+class AccountCache:
+    '''
+    Caches the results of account_balance, account_information,
+    account_representative, account_weight and pending per account.
+
+    A result is served unchecked for the first staleness[method][0]
+    seconds. After that, and up to staleness[method][1] seconds, it is
+    only served if the account frontier is still the one it was fetched
+    under. Frontiers are looked up with accounts_frontiers, checking up
+    to batch_size due accounts in one call. Receivable amounts are not
+    part of the frontier, so pending results and the 'pending' fields of
+    account_balance and account_information can be up to
+    staleness[method][1] seconds old.
+
+    stats holds the number of 'hits', 'misses', 'frontier_calls' and
+    'calls_saved' (hits minus the frontier calls they cost).
+    '''
+    def __init__(self, staleness=None, batch_size=1000, max_entries=100000):
+        self.staleness = dict(DEFAULT_STALENESS)
+        self.staleness.update(staleness or {})
+        self.batch_size = batch_size
+        self.max_entries = max_entries
+        # key: (value, frontier, fetched at)
+        self._entries = OrderedDict()
+        # account: (frontier, checked at, needed until), oldest check first
+        self._frontiers = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._frontier_calls = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'frontier_calls': self._frontier_calls,
+                'calls_saved': self._hits - self._frontier_calls,
+                }
+
+    def refresh_frontiers(self, node, accounts):
+        '''
+        Looks up the frontiers of accounts in batches, e.g. to revalidate
+        all accounts of a dashboard at once.
+
+        Returns False if a lookup failed.
+        '''
+        accounts = list(accounts)
+        for i in range(0, len(accounts), self.batch_size):
+            chunk = accounts[i:i + self.batch_size]
+            res = node._request('accounts_frontiers', accounts=chunk)
+            with self._lock:
+                self._frontier_calls += 1
+            if not isinstance(res, dict) or 'error' in res:
+                return False
+            frontiers = res.get('frontiers') or {}
+            now = time.monotonic()
+            with self._lock:
+                for account in chunk:
+                    known = self._frontiers.pop(account, None)
+                    needed = known[2] if known is not None else 0.0
+                    self._frontiers[account] = (frontiers.get(account), now,
+                            needed)
+                while len(self._frontiers) > self.max_entries:
+                    self._frontiers.popitem(last=False)
+        return True
+
+    def _frontier(self, node, account, fresh):
+        '''
+        Returns the frontier of account, checked at most fresh seconds ago,
+        or _NO_FRONTIER if the lookup failed. Other accounts due for a
+        check whose cached results are still usable ride along in the
+        same call; the ones no cached result needs any more are dropped.
+        '''
+        with self._lock:
+            known = self._frontiers.get(account)
+            now = time.monotonic()
+            if known is not None and now - known[1] < fresh:
+                return known[0]
+            due = [account]
+            expired = []
+            # Oldest checks come first, so stop at the first fresh one
+            for other, (_, checked, needed) in self._frontiers.items():
+                if len(due) >= self.batch_size or now - checked < fresh:
+                    break
+                if needed <= now:
+                    expired.append(other)
+                elif other != account:
+                    due.append(other)
+            for other in expired:
+                if other != account:
+                    del self._frontiers[other]
+        if not self.refresh_frontiers(node, due):
+            return _NO_FRONTIER
+        with self._lock:
+            known = self._frontiers.get(account)
+        return known[0] if known is not None else _NO_FRONTIER
+
+    def get(self, node, method, account, key, fetch):
+        '''
+        Returns the cached result of method for key, calling fetch() if
+        there is none that is still valid. Failed results (None or a node
+        error) are not cached, and every caller gets its own copy.
+        '''
+        fresh, max_age = self.staleness[method]
+        with self._lock:
+            entry = self._entries.get(key)
+            now = time.monotonic()
+            if entry is not None and now - entry[2] < fresh:
+                self._hits += 1
+                return copy.deepcopy(entry[0])
+        validated = max_age > fresh
+        frontier = None
+        if validated:
+            frontier = self._frontier(node, account, fresh)
+            if frontier is _NO_FRONTIER:
+                # Behave like an uncached call
+                with self._lock:
+                    self._misses += 1
+                return fetch()
+            if (entry is not None and now - entry[2] < max_age and
+                    entry[1] == frontier):
+                with self._lock:
+                    self._hits += 1
+                return copy.deepcopy(entry[0])
+        value = fetch()
+        with self._lock:
+            self._misses += 1
+            if value is None or isinstance(value, dict) and 'error' in value:
+                return value
+            fetched = time.monotonic()
+            self._entries[key] = (copy.deepcopy(value), frontier, fetched)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            known = self._frontiers.get(account)
+            if validated and known is not None:
+                self._frontiers[account] = (known[0], known[1],
+                        max(known[2], fetched + max_age))
+        return value
+
+# Actions without side effects, the only ones SingleFlight may merge
+READ_ONLY_ACTIONS = frozenset([
+    'account_balance', 'account_block_count', 'account_get',
+    'account_history', 'account_info', 'account_key', 'account_list',
+    'account_representative', 'account_weight', 'accounts_balances',
+    'accounts_frontiers', 'accounts_pending', 'available_supply', 'block',
+    'block_account', 'block_count', 'block_count_type', 'blocks',
+    'blocks_info', 'chain', 'delegators', 'delegators_count', 'frontiers',
+    'frontier_count', 'history', 'krai_from_raw', 'krai_to_raw', 'ledger',
+    'mrai_from_raw', 'mrai_to_raw', 'pending', 'rai_from_raw', 'rai_to_raw',
+    ])
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Lets concurrent identical calls share one in-flight call.
+
+    shared counts the calls that were answered by another call.
+    '''
+    def __init__(self):
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        '''
+        Returns fn(), or a copy of the result of the fn() already running
+        for key.
+        '''
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.result)
+        try:
+            flight.result = fn()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+def _account_cached(method):
+    ''' Serves method through the node's AccountCache, if it has one '''
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.account_cache is None:
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = list(bound.arguments.values())[1:]
+        key = (method.__name__,) + tuple(params)
+        return self.account_cache.get(self, method.__name__, params[0], key,
+                lambda: method(self, *args, **kwargs))
+    return wrapper
+
 class Rai_node:
-    def __init__(self, uri, password=''):
+    def __init__(self, uri, password='', limiter=None, capture=None,
+            account_cache=None, single_flight=False):
+        '''
+        limiter is an optional AdaptiveLimiter all RPC calls go through.
+        capture is an optional TrafficCapture (or a path to create one)
+        all RPC calls are recorded to.
+        account_cache is an optional AccountCache for account queries.
+        single_flight makes concurrent identical read-only calls (see
+        READ_ONLY_ACTIONS) share one request; pass True or a SingleFlight.
+        '''
         self.uri = uri
         self.password = password
+        self.limiter = limiter
+        self.account_cache = account_cache
+        if single_flight is True:
+            single_flight = SingleFlight()
+        self.single_flight = single_flight or None
+        if isinstance(capture, str):
+            capture = TrafficCapture(capture)
+        self.capture = capture
 
     def _bool_to_str(self, boolean):
         ''' transforms a boolean into a true/false string '''
@@ -22,17 +706,85 @@ class Rai_node:
         return x
 
 
+    def _request(self, action, **params):
+        '''
+        Builds a JSON request for action out of params and sends it.
+        Lists are serialized as real JSON arrays.
+        '''
+        params['action'] = action
+        return self.send_rpc_request(json.dumps(params))
+
+    def _checked_request(self, action, **params):
+        '''
+        Like _request(), but raises RpcError if the call failed or the
+        node answered with an error.
+        '''
+        res = self._request(action, **params)
+        if res is None:
+            raise RpcError('%s request failed' % action)
+        if not isinstance(res, dict):
+            raise RpcError('unexpected %s response' % action)
+        if 'error' in res:
+            raise RpcError('%s: %s' % (action, res['error']))
+        return res
+
     def send_rpc_request(self, data):
         '''
         Sends off POST request to rai_node, returns dict result.
         If bad response, returns None
         '''
-        response = requests.post(self.uri, data=data)
+        action = _action_of(data)
+        if self.single_flight is None or action not in READ_ONLY_ACTIONS:
+            return self._post(action, data)
+        try:
+            params = json.loads(data)
+        except ValueError:
+            return self._post(action, data)
+        if action == 'account_representative' and 'wallet' in params:
+            # set_representative shares the action name
+            return self._post(action, data)
+        # A SingleFlight may be shared between nodes
+        key = (self.uri, json.dumps(params, sort_keys=True))
+        return self.single_flight.do(key, lambda: self._post(action, data))
+
+    def _send(self, action, data, stream=False):
+        '''
+        POSTs data through the limiter and capture and returns the
+        response. The limiter slot is given back as soon as the response
+        headers arrive, so a streamed body does not hold it. Streamed
+        calls are captured with their Content-Length as size.
+        '''
+        if self.limiter is not None:
+            self.limiter.acquire(action)
+        stamp = time.time()
+        start = time.monotonic()
+        ok = False
+        response = None
+        try:
+            response = requests.post(self.uri, data=data, stream=stream)
+            ok = response.ok
+        finally:
+            duration = time.monotonic() - start
+            if self.limiter is not None:
+                self.limiter.release(action, duration, ok)
+            if self.capture is not None:
+                if response is None:
+                    size = FAILED_SIZE
+                elif stream:
+                    size = int(response.headers.get('Content-Length', 0))
+                else:
+                    size = len(response.content)
+                self.capture.record(stamp, duration, size, data)
+        return response
+
+    def _post(self, action, data):
+        response = self._send(action, data)
         if not response.ok:
             return None
         resp_dict = json.loads(response.text)
         return resp_dict
 
+    @_account_cached
     def account_balance(self, address):
         '''
         Get number of blocks for a specific account
@@ -60,6 +812,7 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return res['block_count']
 
+    @_account_cached
     def account_information(self, account):
         '''
         Returns:
@@ -153,14 +906,8 @@ class Rai_node:
         '''
 
         accounts = self._to_list(accounts)
-
-        request='''{
-        "action":"account_move",
-        "wallet":"%s",
-        "source":"%s",
-        "accounts":"%s"
-        }''' % (dst_wallet, src_wallet, accounts)
-        res = self.send_rpc_request(request)
+        res = self._request('account_move', wallet=dst_wallet,
+                source=src_wallet, accounts=accounts)
         return int(res['moved'])
 
     def account_remove(self, wallet, account):
@@ -177,6 +924,119 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return int(res['removed'])
 
+    def iter_account_list(self, wallet, chunk_size=65536):
+        '''
+        Streams the xrb_ addresses inside wallet without holding the
+        whole account_list response in memory.
+
+        Raises RpcError on a bad HTTP response or if the node answers with
+        an error.
+        '''
+        data = json.dumps({'action': 'account_list', 'wallet': wallet})
+        response = self._send('account_list', data, stream=True)
+        try:
+            if not response.ok:
+                raise RpcError('account_list failed with HTTP status %s' %
+                        response.status_code)
+            head = ''
+            found = False
+            tail = ''
+            for chunk in response.iter_content(chunk_size, decode_unicode=True):
+                if isinstance(chunk, bytes):
+                    chunk = chunk.decode()
+                if not found and len(head) < 1024:
+                    head += chunk
+                buf = tail + chunk
+                end = 0
+                for match in _ADDRESS_RE.finditer(buf):
+                    found = True
+                    yield match.group(0)
+                    end = match.end()
+                # Keep what could be the start of a cut off address
+                tail = buf[max(end, len(buf) - 64):]
+            if not found:
+                try:
+                    res = json.loads(head)
+                except ValueError:
+                    res = None
+                if isinstance(res, dict) and 'error' in res:
+                    raise RpcError(res['error'])
+        finally:
+            response.close()
+
+    def bulk_accounts_create(self, wallet, total, chunk_size=1000, workers=4,
+            work=True, progress=None):
+        '''
+        Creates total new accounts in wallet with accounts_create calls of
+        up to chunk_size accounts, running workers calls in parallel.
+
+        Calls progress(created, total) after each call and returns the
+        list of created xrb_ addresses. If any call fails, the others still
+        run and BulkCreateError is raised at the end, carrying the
+        addresses that were created.
+        '''
+        counts = [chunk_size] * (total // chunk_size)
+        if total % chunk_size:
+            counts.append(total % chunk_size)
+
+        def create(count):
+            try:
+                res = self._checked_request('accounts_create', wallet=wallet,
+                        count=str(count), work=self._bool_to_str(work))
+                return res.get('accounts') or [], None
+            except (RpcError, requests.RequestException, ValueError) as e:
+                return [], e
+
+        created = []
+        errors = []
+        for accounts, error in _bounded_map(create, counts, workers):
+            created.extend(accounts)
+            if error is not None:
+                errors.append(error)
+            if progress is not None:
+                progress(len(created), total)
+        if errors:
+            raise BulkCreateError(created, errors)
+        return created
+
+    def bulk_account_move(self, src_wallet, dst_wallet, accounts,
+            chunk_size=1000, workers=4, progress=None):
+        '''
+        Moves accounts (any iterable, e.g. iter_account_list()) from
+        src_wallet to dst_wallet in account_move calls of up to chunk_size
+        accounts, running workers calls in parallel.
+
+        Calls progress(moved, None) after each call and returns the
+        number of moved accounts.
+        '''
+        moved = 0
+        for count in _bounded_map(
+                lambda chunk: self.account_move(src_wallet, dst_wallet, chunk),
+                _chunks(accounts, chunk_size), workers):
+            moved += count
+            if progress is not None:
+                progress(moved, None)
+        return moved
+
+    def bulk_account_remove(self, wallet, accounts, workers=8, progress=None):
+        '''
+        Removes accounts (any iterable) from wallet, running workers
+        account_remove calls in parallel. The node has no batch remove
+        action, so every account takes its own call.
+
+        Calls progress(removed, None) after each call and returns the
+        number of removed accounts.
+        '''
+        removed = 0
+        for count in _bounded_map(
+                lambda account: self.account_remove(wallet, account),
+                accounts, workers):
+            removed += count
+            if progress is not None:
+                progress(removed, None)
+        return removed
+
+    @_account_cached
     def account_representative(self, account):
         '''
         Returns the representative for account
@@ -205,6 +1065,7 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return res['block']
 
+    @_account_cached
     def account_weight(self, account):
         '''
         Gets the voting weight of an account
@@ -434,6 +1295,144 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return res['blocks']
 
+    def _chain_page(self, block, count, inclusive=True):
+        '''
+        Returns up to count block hashes going backward from block.
+        If inclusive is False, block itself is left out.
+        '''
+        if inclusive:
+            res = self._checked_request('chain', block=block, count=str(count))
+            return res.get('blocks') or []
+        res = self._checked_request('chain', block=block, count=str(count + 1))
+        return (res.get('blocks') or [])[1:]
+
+    def walk_chain(self, block, page_size=1000, batch_size=1000):
+        '''
+        Walks an account chain backward starting at block (usually the
+        frontier) down to the open block.
+
+        Yields (hash, info) pairs in chain order, where info is the
+        blocks_info entry of the block. Block bodies are fetched with
+        batched blocks_info calls of up to batch_size hashes while the
+        next chain page is already being requested.
+
+        Raises RpcError if a call fails or misses a block.
+        '''
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            page = self._chain_page(block, page_size)
+            while page:
+                if len(page) < page_size:
+                    upcoming = None
+                else:
+                    upcoming = pool.submit(
+                            self._chain_page, page[-1], page_size, False)
+                for i in range(0, len(page), batch_size):
+                    hashes = page[i:i + batch_size]
+                    infos = self._checked_request('blocks_info',
+                            hashes=hashes)
+                    infos = infos.get('blocks') or {}
+                    missing = [h for h in hashes if h not in infos]
+                    if missing:
+                        raise RpcError('blocks_info misses %d of %d blocks, '
+                                'e.g. %s' % (len(missing), len(hashes),
+                                missing[0]))
+                    for h in hashes:
+                        yield h, infos[h]
+                page = upcoming.result() if upcoming else None
+
+    def walk_chains(self, accounts, workers=8, page_size=1000,
+            batch_size=1000, buffered=64):
+        '''
+        Reconstructs the full chains of many accounts concurrently.
+
+        Frontiers are looked up with batched accounts_frontiers calls and
+        at most workers chains are walked at the same time (see
+        walk_chain()).
+
+        Yields (account, blocks) tuples where blocks is a list of up to
+        batch_size (hash, info) pairs. The pieces of one account come in
+        chain order, frontier first, and the last piece of every account
+        is followed by (account, None). Accounts without a frontier (not
+        opened, or unknown to the node) are yielded once as
+        (account, NOT_FOUND) instead. Pieces of different accounts may
+        interleave. At most buffered pieces are held in memory.
+
+        Raises RpcError if a call fails.
+        '''
+        results = queue.Queue(maxsize=buffered)
+        slots = threading.Semaphore(workers)
+        stop = threading.Event()
+        finished = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def walk(account, frontier):
+            try:
+                piece = []
+                for pair in self.walk_chain(frontier, page_size, batch_size):
+                    piece.append(pair)
+                    if len(piece) == batch_size:
+                        if not put((account, piece)):
+                            return
+                        piece = []
+                if piece and not put((account, piece)):
+                    return
+                put((account, None))
+            except Exception as e:
+                put(e)
+            finally:
+                slots.release()
+
+        def feed():
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    chunk = []
+                    for account in accounts:
+                        chunk.append(account)
+                        if len(chunk) == batch_size:
+                            submit(pool, chunk)
+                            chunk = []
+                    if chunk:
+                        submit(pool, chunk)
+            except Exception as e:
+                put(e)
+            put(finished)
+
+        def submit(pool, chunk):
+            frontiers = self._checked_request('accounts_frontiers',
+                    accounts=chunk)
+            frontiers = frontiers.get('frontiers') or {}
+            for account in chunk:
+                if stop.is_set():
+                    return
+                if account not in frontiers:
+                    put((account, NOT_FOUND))
+                    continue
+                while not slots.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                pool.submit(walk, account, frontiers[account])
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        try:
+            while True:
+                item = results.get()
+                if item is finished:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
     def delegators(self, account):
         '''
         Returns a list of pairs of delegator names given account a
@@ -783,6 +1782,7 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return res['block']
 
+    @_account_cached
     def pending(self, account, count=1):
         request='''{
         "action":"pending",
@@ -817,12 +1817,195 @@ class Rai_node:
         res = self.send_rpc_request(request)
         return res['blocks']
 
-if __name__=="__main__":
+# Single-item actions that are merged into one call of a batch action:
+# action: (batch action, item key, batch key, result key, wrap key)
+BATCHABLE = {
+    'account_balance': ('accounts_balances', 'account', 'accounts', 'balances',
+        None),
+    'block': ('blocks', 'hash', 'hashes', 'blocks', 'contents'),
+    'pending': ('accounts_pending', 'account', 'accounts', 'blocks', 'blocks'),
+}
+
+def _run_single(node, index, req):
+    try:
+        res = node.send_rpc_request(json.dumps(req))
+    except (requests.RequestException, ValueError) as e:
+        return [(index, None, str(e))]
+    if res is None:
+        return [(index, None, 'request failed')]
+    if isinstance(res, dict) and 'error' in res:
+        return [(index, None, res['error'])]
+    return [(index, res, None)]
+
+def _run_batch(node, action, others, items):
+    '''
+    Sends items, a list of (index, item) of the same single-item action
+    and extra params, as one batch call and splits the result up again.
+    If the node rejects the whole batch, the items are retried one by one
+    so each gets its own result or error.
+    '''
+    batch_action, item_key, batch_key, result_key, wrap = BATCHABLE[action]
+    params = dict(others)
+    params[batch_key] = [item for _, item in items]
+    params['action'] = batch_action
+    try:
+        res = node.send_rpc_request(json.dumps(params))
+    except (requests.RequestException, ValueError) as e:
+        return [(index, None, str(e)) for index, _ in items]
+    if res is None:
+        return [(index, None, 'request failed') for index, _ in items]
+    if not isinstance(res, dict) or 'error' in res:
+        out = []
+        for index, item in items:
+            req = dict(others)
+            req[item_key] = item
+            req['action'] = action
+            out.extend(_run_single(node, index, req))
+        return out
+    results = res.get(result_key) or {}
+    out = []
+    for index, item in items:
+        if item not in results:
+            out.append((index, None, 'missing from %s result' % batch_action))
+        elif wrap is None:
+            out.append((index, results[item], None))
+        else:
+            out.append((index, {wrap: results[item]}, None))
+    return out
+
+def _run_unit(node, indices, fn, args):
+    '''
+    Runs a unit of work, turning any unexpected failure into an error
+    for each of its lines.
+    '''
+    try:
+        return fn(node, *args)
+    except Exception as e:
+        return [(index, None, '%s: %s' % (type(e).__name__, e))
+                for index in indices]
+
+def _bad_request(node, index, error):
+    return [(index, None, 'bad request: %s' % error)]
+
+def _plan(window, batch_size):
+    '''
+    Splits a window of (index, line) into units of work, each a
+    (line indices, function, args) tuple; the function returns a list
+    of (index, result, error).
     '''
-    Demos these rpc commands
+    units = []
+    groups = {}
+    for index, line in window:
+        try:
+            req = json.loads(line)
+            action = req['action']
+        except (ValueError, KeyError, TypeError) as e:
+            units.append(([index], _bad_request, (index, e)))
+            continue
+        if not isinstance(action, str):
+            units.append(([index], _bad_request,
+                    (index, 'action must be a string')))
+            continue
+        entry = BATCHABLE.get(action)
+        if entry is None or not isinstance(req.get(entry[1]), str):
+            units.append(([index], _run_single, (index, req)))
+            continue
+        others = tuple(sorted((k, v) for k, v in req.items()
+                if k not in ('action', entry[1])))
+        try:
+            group = groups.setdefault((action, others), [])
+        except TypeError:
+            units.append(([index], _run_single, (index, req)))
+            continue
+        group.append((index, req[entry[1]]))
+        if len(group) == batch_size:
+            units.append(([i for i, _ in group], _run_batch,
+                    (action, others, group)))
+            del groups[(action, others)]
+    for (action, others), group in groups.items():
+        units.append(([i for i, _ in group], _run_batch,
+                (action, others, group)))
+    return units
+
+def run_bulk(node, lines, out, concurrency=8, batch_size=100, ordered=True):
     '''
-    demo_address = 0
+    Runs NDJSON requests ({"action": ..., params...}) read from lines
+    through node and writes one NDJSON result per request to out:
+        {"line": n, "result": {...}} or {"line": n, "error": "..."}
+
+    Requests with a batchable action (see BATCHABLE) and the same extra
+    params are merged into batch calls of up to batch_size items.
+    Input is consumed in windows of concurrency * batch_size lines, so
+    memory stays constant however long the input is. With ordered=False
+    results are written as they complete instead of in input order.
+    '''
+    window_size = concurrency * batch_size
 
-    # Get the Block Count
-    print("Get Block Count")
-    pprint(get_block_count())
+    def write(index, result, error):
+        if error is None:
+            line = {'line': index, 'result': result}
+        else:
+            line = {'line': index, 'error': error}
+        out.write(json.dumps(line) + '\n')
+
+    numbered = ((i, line) for i, line in enumerate(lines, 1) if line.strip())
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            window = list(itertools.islice(numbered, window_size))
+            if not window:
+                break
+            futures = [pool.submit(_run_unit, node, *unit)
+                    for unit in _plan(window, batch_size)]
+            if ordered:
+                results = {}
+                for future in futures:
+                    for index, result, error in future.result():
+                        results[index] = (result, error)
+                for index, _ in window:
+                    write(index, *results[index])
+            else:
+                for future in as_completed(futures):
+                    for row in future.result():
+                        write(*row)
+            out.flush()
+
+def main(argv=None):
+    '''
+    Command line entry point, see --help
+    '''
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(
+            description='Runs NDJSON rai_node requests in bulk.',
+            epilog='See "rai_rpc.py replay --help" to replay traffic '
+            'captures.')
+    parser.add_argument('input', nargs='?', default='-',
+            help='NDJSON file of requests, - for stdin (default)')
+    parser.add_argument('--uri', default='http://[::1]:7076',
+            help='rai_node RPC address (default: %(default)s)')
+    parser.add_argument('--concurrency', type=int, default=8,
+            help='parallel RPC calls (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=100,
+            help='items merged into one batch call (default: %(default)s)')
+    parser.add_argument('--unordered', action='store_true',
+            help='write results as they complete')
+    args = parser.parse_args(argv)
+
+    node = Rai_node(args.uri)
+    if args.input == '-':
+        lines = sys.stdin
+    else:
+        lines = open(args.input)
+    try:
+        run_bulk(node, lines, sys.stdout, args.concurrency,
+                args.batch_size, not args.unordered)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+if __name__=="__main__":
+    import sys
+    if sys.argv[1:2] == ['replay']:
+        replay_main(sys.argv[2:])
+    else:
+        main()
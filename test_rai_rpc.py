@@ -0,0 +1,327 @@
+import json
+import threading
+import time
+
+import pytest
+
+import rai_rpc
+
+
+class FakeResponse:
+    def __init__(self, body, ok=True):
+        self.ok = ok
+        self.text = json.dumps(body)
+        self.content = self.text.encode()
+        self.headers = {}
+
+    def close(self):
+        pass
+
+
+class FakeNode:
+    '''
+    Stands in for requests.post, answering with handler(request dict) and
+    counting the calls per action.
+    '''
+    def __init__(self, handler, delay=0.0):
+        self.handler = handler
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, uri, data=None, **kwargs):
+        req = json.loads(data)
+        with self._lock:
+            self.calls.append(req['action'])
+        if self.delay:
+            time.sleep(self.delay)
+        return FakeResponse(self.handler(req))
+
+    def count(self, action):
+        return self.calls.count(action)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_limiter_serves_payment_lane_first():
+    limiter = rai_rpc.AdaptiveLimiter(initial=1)
+    limiter.acquire('block_count')
+    order = []
+
+    def call(action):
+        limiter.acquire(action)
+        order.append(action)
+        limiter.release(action, 0.01)
+
+    threads = [threading.Thread(target=call, args=('ledger',))]
+    threads[0].start()
+    wait_for(lambda: len(limiter._waiting) == 1)
+    threads.append(threading.Thread(target=call, args=('send',)))
+    threads[1].start()
+    wait_for(lambda: len(limiter._waiting) == 2)
+
+    limiter.release('block_count', 0.01)
+    for thread in threads:
+        thread.join(5)
+    assert order == ['send', 'ledger']
+    assert limiter.in_flight == 0
+
+
+def test_limiter_increases_additively():
+    limiter = rai_rpc.AdaptiveLimiter(initial=4)
+    limiter.acquire('block_count')
+    limiter.release('block_count', 0.01)
+    assert limiter.limit == pytest.approx(4.25)
+
+
+def test_limiter_halves_on_failure_once_per_window():
+    limiter = rai_rpc.AdaptiveLimiter(initial=32)
+    limiter.acquire('block_count')
+    limiter.release('block_count', 0.01, ok=False)
+    assert limiter.limit == 16
+    # Started before the decrease above, so it does not count again
+    limiter.acquire('block_count')
+    limiter.release('block_count', 10.0, ok=False)
+    assert limiter.limit == 16
+
+
+def test_limiter_ignores_mixed_call_sizes():
+    limiter = rai_rpc.AdaptiveLimiter(initial=32)
+    for i in range(500):
+        limiter.acquire('blocks_info')
+        limiter.release('blocks_info', 0.01 if i % 10 == 0 else 0.1)
+    assert limiter.limit > 32
+
+
+def test_limiter_backs_off_on_latency_spike():
+    limiter = rai_rpc.AdaptiveLimiter(initial=32)
+    for _ in range(100):
+        limiter.acquire('blocks_info')
+        limiter.release('blocks_info', 0.1)
+    before = limiter.limit
+    limiter._last_decrease = 0.0
+    limiter.acquire('blocks_info')
+    limiter.release('blocks_info', 1.0)
+    assert limiter.limit == pytest.approx(before * 0.5)
+
+
+def test_limiter_bounds_calls_in_flight(monkeypatch):
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def post(uri, data=None, **kwargs):
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.005)
+        with lock:
+            in_flight.pop()
+        return FakeResponse({'count': '1', 'unchecked': '0'})
+
+    monkeypatch.setattr(rai_rpc.requests, 'post', post)
+    limiter = rai_rpc.AdaptiveLimiter(initial=2, maximum=2)
+    node = rai_rpc.Rai_node('uri', limiter=limiter)
+    threads = [threading.Thread(target=node.block_count) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert max(peak) <= 2
+    assert limiter.in_flight == 0
+
+
+def test_replay_orders_capture_by_start_time():
+    lines = [
+        '[5.0,0.1,10,"a"]',
+        '[1.0,4.5,10,"b"]',
+        '[6.0,0.1,10,"c"]',
+        '[100.0,0.1,10,"d"]',
+        ]
+    calls = list(rai_rpc._calls_by_start(lines, window=1.0))
+    assert [data for _, data in calls] == ['b', 'a', 'c', 'd']
+
+
+ACCOUNT = 'xrb_3t6k35gi95xu6tergt6p69ck76ogmitsa8mnijtpxm9fkcm736xtoncuohr3'
+
+
+class FakeLedger:
+    ''' Answers account_balance and accounts_frontiers for ACCOUNT '''
+    def __init__(self):
+        self.frontier = 'A' * 64
+        self.balance = '10'
+        self.error = None
+
+    def __call__(self, req):
+        if self.error is not None:
+            return {'error': self.error}
+        if req['action'] == 'accounts_frontiers':
+            return {'frontiers': {ACCOUNT: self.frontier}}
+        return {'balance': self.balance, 'pending': '0'}
+
+
+def cached_node(monkeypatch, ledger, staleness=(60, 600)):
+    fake = FakeNode(ledger)
+    monkeypatch.setattr(rai_rpc.requests, 'post', fake)
+    cache = rai_rpc.AccountCache(staleness={'account_balance': staleness})
+    return rai_rpc.Rai_node('uri', account_cache=cache), fake
+
+
+def test_account_balance_keyword_call(monkeypatch):
+    fake = FakeNode(FakeLedger())
+    monkeypatch.setattr(rai_rpc.requests, 'post', fake)
+    assert rai_rpc.Rai_node('uri').account_balance(address=ACCOUNT)
+    node, _ = cached_node(monkeypatch, FakeLedger())
+    assert node.account_balance(address=ACCOUNT)['balance'] == '10'
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+    assert node.account_cache.stats['hits'] == 1
+
+
+def test_cache_hit_within_ttl(monkeypatch):
+    node, fake = cached_node(monkeypatch, FakeLedger())
+    for _ in range(5):
+        assert node.account_balance(ACCOUNT)['balance'] == '10'
+    assert fake.count('account_balance') == 1
+    assert node.account_cache.stats['hits'] == 4
+
+
+def test_cache_invalidated_by_frontier_change(monkeypatch):
+    ledger = FakeLedger()
+    node, fake = cached_node(monkeypatch, ledger, staleness=(0, 600))
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+    assert fake.count('account_balance') == 1
+
+    ledger.frontier = 'B' * 64
+    ledger.balance = '20'
+    assert node.account_balance(ACCOUNT)['balance'] == '20'
+    assert fake.count('account_balance') == 2
+
+
+def test_cache_skips_errors(monkeypatch):
+    ledger = FakeLedger()
+    ledger.error = 'Bad account number'
+    node, fake = cached_node(monkeypatch, ledger)
+    assert node.account_balance(ACCOUNT) == {'error': 'Bad account number'}
+    ledger.error = None
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+
+
+def test_cache_returns_copies(monkeypatch):
+    node, _ = cached_node(monkeypatch, FakeLedger())
+    node.account_balance(ACCOUNT)['balance'] = '999'
+    node.account_balance(ACCOUNT)['balance'] = '999'
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+
+
+def test_cache_falls_back_when_frontier_lookup_fails(monkeypatch):
+    def post(uri, data=None, **kwargs):
+        if 'accounts_frontiers' in data:
+            return FakeResponse({}, ok=False)
+        return FakeResponse({'balance': '10', 'pending': '0'})
+
+    monkeypatch.setattr(rai_rpc.requests, 'post', post)
+    cache = rai_rpc.AccountCache(staleness={'account_balance': (0, 600)})
+    node = rai_rpc.Rai_node('uri', account_cache=cache)
+    assert node.account_balance(ACCOUNT)['balance'] == '10'
+
+
+def test_cache_drops_idle_frontiers(monkeypatch):
+    checked = []
+
+    def handler(req):
+        if req['action'] == 'accounts_frontiers':
+            checked.append(req['accounts'])
+            return {'frontiers': {a: 'A' * 64 for a in req['accounts']}}
+        return {'balance': '10', 'pending': '0'}
+
+    monkeypatch.setattr(rai_rpc.requests, 'post', FakeNode(handler))
+    cache = rai_rpc.AccountCache(staleness={'account_balance': (0, 0.05)})
+    node = rai_rpc.Rai_node('uri', account_cache=cache)
+    node.account_balance('xrb_a')
+    node.account_balance('xrb_b')
+    assert checked[-1] == ['xrb_b', 'xrb_a']
+    time.sleep(0.06)
+    node.account_balance('xrb_a')
+    assert checked[-1] == ['xrb_a']
+
+
+def run_concurrently(fn, count=8):
+    threads = [threading.Thread(target=fn) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_single_flight_merges_identical_reads(monkeypatch):
+    fake = FakeNode(lambda req: {'accounts': {}}, delay=0.05)
+    monkeypatch.setattr(rai_rpc.requests, 'post', fake)
+    node = rai_rpc.Rai_node('uri', single_flight=True)
+    run_concurrently(lambda: node.ledger(ACCOUNT, 10))
+    assert fake.count('ledger') == 1
+    assert node.single_flight.shared == 7
+
+
+def test_single_flight_keeps_mutations_apart(monkeypatch):
+    fake = FakeNode(lambda req: {'block': 'A' * 64, 'account': ACCOUNT},
+            delay=0.05)
+    monkeypatch.setattr(rai_rpc.requests, 'post', fake)
+    node = rai_rpc.Rai_node('uri', single_flight=True)
+    run_concurrently(lambda: node.receive('W', ACCOUNT, 'B' * 64), 4)
+    run_concurrently(lambda: node.set_representative('W', ACCOUNT, ACCOUNT), 4)
+    run_concurrently(lambda: node._request('account_create', wallet='W'), 4)
+    assert fake.count('receive') == 4
+    assert fake.count('account_representative') == 4
+    assert fake.count('account_create') == 4
+
+
+def test_single_flight_keeps_nodes_apart(monkeypatch):
+    uris = []
+
+    def post(uri, data=None, **kwargs):
+        uris.append(uri)
+        time.sleep(0.05)
+        return FakeResponse({'count': uri, 'unchecked': '0'})
+
+    monkeypatch.setattr(rai_rpc.requests, 'post', post)
+    flight = rai_rpc.SingleFlight()
+    nodes = [rai_rpc.Rai_node(uri, single_flight=flight) for uri in 'ab']
+    results = []
+    run_concurrently(lambda: results.extend(
+            node.block_count()['count'] for node in nodes), 2)
+    assert sorted(uris) == ['a', 'b']
+    assert sorted(results) == ['a', 'a', 'b', 'b']
+
+
+def test_bulk_create_reports_partial_results(monkeypatch):
+    calls = []
+
+    def handler(req):
+        calls.append(req['count'])
+        if len(calls) == 2:
+            return {'error': 'Wallet locked'}
+        return {'accounts': ['xrb_%d_%d' % (len(calls), i)
+                for i in range(int(req['count']))]}
+
+    monkeypatch.setattr(rai_rpc.requests, 'post', FakeNode(handler))
+    node = rai_rpc.Rai_node('uri')
+    with pytest.raises(rai_rpc.BulkCreateError) as info:
+        node.bulk_accounts_create('W', 25, chunk_size=10, workers=1)
+    assert len(info.value.created) == 15
+    assert len(info.value.errors) == 1
+
+
+def test_account_list_stream_raises_on_bad_status(monkeypatch):
+    response = FakeResponse({}, ok=False)
+    response.status_code = 500
+    monkeypatch.setattr(rai_rpc.requests, 'post',
+            lambda uri, data=None, **kwargs: response)
+    node = rai_rpc.Rai_node('uri')
+    with pytest.raises(rai_rpc.RpcError):
+        node.bulk_account_move('A', 'B', node.iter_account_list('A'))